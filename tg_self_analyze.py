@@ -22,17 +22,45 @@
     python tg_self_analyze.py --in Kirill.json --user-id 305696040
 """
 
-import argparse, json, re, csv, unicodedata
-from typing import List, Dict, Any, Optional, Tuple
-from collections import defaultdict
+import argparse, json, re, csv, mmap, os, unicodedata
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Set, Callable
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# ---------- регэкспы (компилируются один раз) ----------
+_RE_NAME = re.compile(r'"name"\s*:\s*"([^"]*)"')
+_RE_ID = re.compile(r'"id"\s*:\s*([0-9]+)')
+_RE_MSGS = re.compile(r'"messages"\s*:\s*\[')
+# первый из якорей в файле: chats.list (полный экспорт) или массив messages (чат/склейка)
+_RE_FORMAT = re.compile(
+    r'(?P<chats>"chats"\s*:\s*\{\s*(?:"about"\s*:\s*"(?:[^"\\]|\\.)*"\s*,\s*)?"list"\s*:\s*\[)'
+    r'|(?P<messages>"messages"\s*:\s*\[)'
+)
+_RE_WS = re.compile(r"\s+")
+# шапка объекта: '{' и пары "ключ": скаляр (у чата — до messages, у сообщения — до text)
+_RE_HEAD = re.compile(
+    r'\{\s*(?:"[^"\\]*(?:\\.[^"\\]*)*"\s*:\s*'
+    r'(?:"[^"\\]*(?:\\.[^"\\]*)*"|-?[0-9]+|true|false|null)\s*,\s*)*'
+)
+# начало сообщения: в экспорте Telegram "id" всегда первое поле
+_RE_MSG_ID = re.compile(r'\{\s*"id"\s*:\s*(-?[0-9]+)')
+_RE_BRACE_TOKEN = re.compile(r'[{}"]')
+_RE_STR_TAIL = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+# разделители между объектами: пробелы, запятые, BOM и узкие пробелы
+_RE_SKIP = re.compile(r'[ \r\n\t,\ufeff\u00A0\u2009\u202F]*')
 
 # ---------- утилки ----------
+# любой юникод-пробел (NBSP, узкие, табы, переводы строк...) → обычный пробел;
+# все они лежат не дальше U+3000
+_SPACE_TABLE = str.maketrans({chr(c): " " for c in range(0x3001) if chr(c).isspace()})
+
 def u_norm(s: str) -> str:
-    if s is None:
+    if not s:
         return ""
-    s = unicodedata.normalize("NFKC", str(s))
-    s = s.replace("\u00A0", " ").replace("\u2009", " ").replace("\u202F", " ")
-    s = re.sub(r"\s+", " ", s)
+    s = unicodedata.normalize("NFKC", str(s)).translate(_SPACE_TABLE)
+    # после translate пробелы только обычные: регэксп нужен лишь для повторов
+    if "  " in s:
+        s = _RE_WS.sub(" ", s)
     return s.strip()
 
 def extract_text(msg: Dict[str, Any]) -> str:
@@ -40,6 +68,8 @@ def extract_text(msg: Dict[str, Any]) -> str:
     if isinstance(t, str):
         return t
     if isinstance(t, list):
+        # Цикл с append оставлен намеренно: до Python 3.12 списковое включение в join
+        # медленнее (отдельный кадр функции + isinstance с кортежем типов), проверено timeit.
         parts: List[str] = []
         for x in t:
             if isinstance(x, str):
@@ -52,16 +82,37 @@ def extract_text(msg: Dict[str, Any]) -> str:
 def strip_bom(s: str) -> str:
     return s.lstrip("\ufeff")
 
+def read_export(path: str) -> str:
+    """
+    Весь экспорт одной строкой. Файл отображается в память и декодируется прямо из mmap:
+    отдельной копии байтов в куче нет, BOM снимает сам кодек (utf-8-sig) без копии строки.
+    """
+    with open(path, "rb") as fb:
+        if os.fstat(fb.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return strip_bom(str(mm, "utf-8-sig"))
+
+# нормализованные имена авторов: их в экспорте единицы, а сообщений — тысячи
+_SENDERS: Dict[str, str] = {}
+
 def norm_sender(m: Dict[str, Any]) -> str:
+    """
+    u_norm имени автора; результат кэшируется по исходной строке, так что фильтр
+    и строка вывода не нормализуют одно имя дважды, а все строки автора делят один объект.
+    """
     s = m.get("from") or m.get("actor") or m.get("from_id") or ""
-    return u_norm(s)
+    name = _SENDERS.get(s)
+    if name is None:
+        name = _SENDERS[s] = u_norm(s)
+    return name
 
 def norm_from_id(m: Dict[str, Any]) -> str:
     """Возвращает from_id как строку вида 'user123...' или ''."""
     fid = m.get("from_id")
-    if fid is None:
-        return ""
-    return str(fid)
+    if isinstance(fid, str):
+        return fid  # обычный случай: строка из экспорта как есть, без str()
+    return "" if fid is None else str(fid)
 
 def want_user_id_string(uid: Optional[int]) -> Optional[str]:
     """Для 305696040 вернет 'user305696040'."""
@@ -69,248 +120,465 @@ def want_user_id_string(uid: Optional[int]) -> Optional[str]:
         return None
     return f"user{int(uid)}"
 
+def author_pattern(uid: Optional[int]) -> Optional[re.Pattern]:
+    """'"from_id": "user305696040"' в том виде, как он лежит в тексте экспорта."""
+    if uid is None:
+        return None
+    return re.compile(r'"from_id"\s*:\s*"' + re.escape(want_user_id_string(uid)) + '"')
+
+def author_filter(user_id: Optional[int],
+                  user_query: Optional[str],
+                  exact: bool) -> Callable[[Dict[str, Any]], bool]:
+    """
+    Проверка «сообщение нашего автора?», выбранная один раз под режим фильтра:
+    в цикле по сообщениям больше не решается, какая из трёх веток нужна.
+    """
+    if user_id is not None:
+        # str == str сравнивается без нормализации и новых строк
+        want = want_user_id_string(user_id)
+        return lambda msg: msg.get("from_id") == want
+    q = user_query or ""
+    if exact:
+        return lambda msg: norm_sender(msg) == q
+    q = q.lower()
+    return lambda msg: q in norm_sender(msg).lower()
+
 # ---------- потоковый парсер объектов { ... } ----------
+# (start, end) объекта-чата внутри raw — вместо копии его текста
+Span = Tuple[int, int]
+
+# чат из list_all_chats: (span, id, name, u_norm(name).lower()) — имя нормализуется один раз
+Chat = Tuple[Span, Optional[int], str, str]
+
+# насколько далеко влево от найденного поля может начинаться шапка объекта
+HEAD_MAX = 4096
+
+_DECODER = json.JSONDecoder()
+
 def stream_next_object(s: str, idx: int) -> Tuple[Optional[str], int]:
+    """
+    Находит конец объекта {...} по балансу скобок, не разбирая его → (текст, конец).
+    Между скобками и кавычками прыгает регэкспами, строки проглатывает целиком.
+    """
     n = len(s)
-    # пропускаем пробелы, запятые и всякий юникод-мусор, включая BOM и узкие пробелы
-    SKIP = " \r\n\t,\ufeff\u00A0\u2009\u202F"
-    while idx < n and s[idx] in SKIP:
-        idx += 1
+    idx = _RE_SKIP.match(s, idx).end()
     if idx >= n or s[idx] != "{":
         return None, idx
     start = idx
     depth = 0
-    in_str = False
-    esc = False
-    while idx < n:
-        ch = s[idx]
-        if in_str:
-            if esc:
-                esc = False
-            elif ch == "\\":
-                esc = True
-            elif ch == '"':
-                in_str = False
+    while True:
+        m = _RE_BRACE_TOKEN.search(s, idx)
+        if not m:
+            return None, n
+        idx = m.end()
+        ch = m.group()
+        if ch == '"':
+            # строку (с экранированием) проглатываем целиком
+            m = _RE_STR_TAIL.match(s, idx)
+            if not m:
+                return None, n
+            idx = m.end()
+        elif ch == "{":
+            depth += 1
         else:
-            if ch == '"':
-                in_str = True
-            elif ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    idx += 1
-                    return s[start:idx], idx
-        idx += 1
-    return None, idx
+            depth -= 1
+            if depth == 0:
+                return s[start:idx], idx
+
+def next_object(s: str, idx: int) -> Tuple[Optional[Dict[str, Any]], int, int]:
+    """
+    Разбирает объект {...} с позиции idx (разделители пропускаются) → (obj, start, end).
+    Разбирает JSONDecoder.raw_decode; битый или обрезанный объект перешагивается сканером скобок, obj=None.
+    start == end — на позиции объекта нет (конец массива, мусор, конец файла).
+    """
+    n = len(s)
+    idx = _RE_SKIP.match(s, idx).end()
+    if idx >= n or s[idx] != "{":
+        return None, idx, idx
+    try:
+        obj, end = _DECODER.raw_decode(s, idx)
+        return obj, idx, end
+    except ValueError:
+        _, end = stream_next_object(s, idx)
+        return None, idx, end
+
+def object_start(raw: str, lo: int, pos: int) -> Optional[int]:
+    """
+    Начало объекта, в шапке которого (только скалярные поля) стоит ключ с позиции pos.
+    Идём по '{' влево (первые могут оказаться внутри строк) до той, с которой _RE_HEAD
+    доходит ровно до pos. None — такой шапки не нашлось.
+    """
+    lo = max(lo, pos - HEAD_MAX)
+    end = pos
+    while True:
+        start = raw.rfind("{", lo, end)
+        if start < 0:
+            return None
+        h = _RE_HEAD.match(raw, start, pos)
+        if h and h.end() == pos:
+            return start
+        end = start
 
 # ---------- распознавание формата ----------
-def has_chats_list(raw: str) -> bool:
-    return re.search(r'"chats"\s*:\s*\{\s*"list"\s*:\s*\[', raw) is not None
-
-def find_chats_list_start(raw: str) -> int:
-    m = re.search(r'"chats"\s*:\s*\{\s*"list"\s*:\s*\[', raw)
-    if not m:
-        raise ValueError("В файле не найден блок 'chats.list'.")
-    return m.end()
+def chats_list_start(raw: str) -> Optional[int]:
+    """
+    Позиция сразу за '"chats": {"list": [' (поле "about" перед list допускается) или None.
+    В полном экспорте chats.list идёт раньше любого массива messages, поэтому поиск
+    останавливается на первом якоре: у одиночного чата и склейки файл целиком не сканируется.
+    """
+    m = _RE_FORMAT.search(raw)
+    return m.end() if m and m.lastgroup == "chats" else None
+
+def head_search(rx: re.Pattern, s: str) -> Optional[re.Match]:
+    """
+    rx.search сначала только по первым HEAD_MAX символам — name и id лежат в шапке объекта.
+    Совпадение, упёршееся в границу, могло обрезаться (id=12 из 12345) — тогда ищем по всей строке.
+    """
+    m = rx.search(s, 0, HEAD_MAX)
+    return m if m and m.end() < HEAD_MAX else rx.search(s)
 
 def chat_name_from_obj_str(chat_obj_str: str) -> str:
-    m = re.search(r'"name"\s*:\s*"([^"]*)"', chat_obj_str)
+    m = head_search(_RE_NAME, chat_obj_str)
     return m.group(1) if m else ""
 
 def chat_id_from_obj_str(chat_obj_str: str) -> Optional[int]:
-    m = re.search(r'"id"\s*:\s*([0-9]+)', chat_obj_str)
+    m = head_search(_RE_ID, chat_obj_str)
     return int(m.group(1)) if m else None
 
-def find_messages_array_in(container: str) -> Optional[int]:
-    m = re.search(r'"messages"\s*:\s*\[', container)
-    return m.end() if m else None
-
-def stream_parse_messages_from_container(container_str: str) -> List[Dict[str, Any]]:
-    start = find_messages_array_in(container_str)
-    if not start:
-        return []
-    after = container_str[start:]
-    msgs: List[Dict[str, Any]] = []
-    idx = 0
-    while idx < len(after):
-        obj_str, idx2 = stream_next_object(after, idx)
-        if not obj_str:
-            # не ломаемся, ползем дальше
-            idx += 1
+def author_messages(raw: str, span: Span, author: re.Pattern) -> Optional[List[Dict[str, Any]]]:
+    """
+    Сообщения автора в порядке файла; прочие не декодируются — автора ищем по тексту
+    (author_pattern). None — совпадение не удалось привязать к сообщению, нужен полный разбор.
+    """
+    a, b = span
+    out: List[Dict[str, Any]] = []
+    lo = a
+    for m in author.finditer(raw, a, b):
+        if m.start() < lo:
+            continue  # внутри уже разобранного сообщения
+        start = object_start(raw, lo, m.start())
+        if start is None:
+            return None
+        msg, _, lo = next_object(raw, start)
+        if msg is not None:
+            out.append(msg)
+    return out
+
+def messages_by_id(raw: str, span: Span, ids: Set[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Сообщения чата с данными id, найденные по шапкам '{"id": N' — декодируются только они.
+    Остальной чат не разбирается; как только нашлись все, поиск прекращается.
+    Ненайденные так (в сообщении "id" не первым полем) ищутся по тексту '"id": N' где угодно,
+    а если совпадение не привязать к искомому сообщению — чат один раз проходится целиком,
+    как в author_messages. Удалённые цели ответов текстом не находятся и разбора не стоят.
+    """
+    a, b = span
+    out: Dict[str, Dict[str, Any]] = {}
+    # ищем только внутри массива messages: в шапке чата свой "id"
+    m = _RE_MSGS.search(raw, a, b)
+    if not m:
+        return out
+    first = m.end()
+
+    # id, чей объект уже разобран: сервисное сообщение с таким id — тоже ответ, просто не в out
+    seen: Set[str] = set()
+    for m in _RE_MSG_ID.finditer(raw, first, b):
+        mid = m.group(1)
+        if mid not in ids or mid in seen:
             continue
-        try:
-            obj = json.loads(obj_str)
-            msgs.append(obj)
-        except Exception:
-            # битый хвост — идем дальше
-            pass
-        idx = idx2 if idx2 > idx else idx + 1
-    return msgs
+        msg, _, _ = next_object(raw, m.start())
+        if msg is not None and str(msg.get("id")) == mid:
+            seen.add(mid)
+            if msg.get("type") == "message":
+                out[mid] = msg
+            if len(seen) == len(ids):
+                return out
+
+    missing = ids - seen
+    rx = re.compile(r'"id"\s*:\s*(?:' + "|".join(map(re.escape, missing)) + r')(?![0-9])')
+    lo = first
+    for m in rx.finditer(raw, first, b):
+        if m.start() < lo:
+            continue  # внутри уже разобранного сообщения
+        start = object_start(raw, lo, m.start())
+        if start is None:
+            break
+        msg, _, lo = next_object(raw, start)
+        mid = str(msg.get("id")) if msg is not None else None
+        if mid not in missing:
+            break  # совпадение не привязалось к искомому объекту — разбираем чат целиком
+        if msg.get("type") == "message":
+            out.setdefault(mid, msg)
+        seen.add(mid)
+        if len(seen) == len(ids):
+            return out
+    else:
+        return out
+
+    for msg in iter_messages(raw, span):
+        if msg.get("type") == "message":
+            mid = str(msg.get("id"))
+            if mid in ids and mid not in out:
+                out[mid] = msg
+                if len(out) == len(ids):
+                    break
+    return out
+
+def iter_messages(raw: str, span: Span, author: Optional[re.Pattern] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Сообщения чата по одному: в памяти живёт только текущее, битые пропускаются.
+    С author — только сообщения этого автора (см. author_messages).
+    """
+    if author is not None:
+        msgs = author_messages(raw, span, author)
+        if msgs is not None:
+            yield from msgs
+            return
+    start, end = span
+    m = _RE_MSGS.search(raw, start, end)
+    if not m:
+        return
+    i = m.end()
+    while i < end:
+        msg, at, i = next_object(raw, i)
+        if at == i:
+            break
+        if msg is not None:
+            yield msg
 
 # ---------- выбор чата ----------
-def is_saved_chat(name: str) -> bool:
-    n = u_norm(name).lower()
-    return "saved messages" in n or "избранное" in n or n == "саня"
-
-def list_all_chats(raw: str, cap: int = 10000) -> List[Tuple[str, Optional[int], str]]:
-    out = []
-    if has_chats_list(raw):
-        i = find_chats_list_start(raw)
-        k = 0
-        while i < len(raw) and k < cap:
-            obj_str, i2 = stream_next_object(raw, i)
-            if not obj_str:
-                i += 1
-                continue
-            if find_messages_array_in(obj_str):
-                out.append((
-                    obj_str,
-                    chat_id_from_obj_str(obj_str),
-                    chat_name_from_obj_str(obj_str) or "(без названия)"
-                ))
-                k += 1
-            i = i2 if i2 > i else i + 1
-        return out
+def is_saved_chat(lname: str) -> bool:
+    """lname — уже нормализованное имя (четвёртое поле Chat)."""
+    return "saved messages" in lname or "избранное" in lname or lname == "саня"
+
+def chat_head(raw: str, lo: int, m: re.Match) -> Optional[Tuple[int, Optional[int], str]]:
+    """
+    (начало, id, name) чата по его якорю "messages": [ — без разбора самих сообщений.
+    Шапка чата (name, type, id) состоит из скаляров: находим её через object_start
+    и декодируем только её.
+    """
+    start = object_start(raw, lo, m.start())
+    if start is not None:
+        try:
+            head = json.loads(raw[start:m.start()] + '"messages": []}')
+        except ValueError:
+            head = None  # _RE_HEAD пропускает невалидный JSON ("a\qb", 007) — идём ниже
+        if head is not None:
+            cid = head.get("id")
+            return start, (cid if isinstance(cid, int) else None), head.get("name") or "(без названия)"
+    # шапка нестандартная (например, с вложенным объектом): идём по '{' влево, пока
+    # кусок до якоря не разберётся как шапка — '{' вложенных объектов и строк не разбираются
+    lo = max(lo, m.start() - HEAD_MAX)
+    end = m.start()
+    while True:
+        start = raw.rfind("{", lo, end)
+        if start < 0:
+            break
+        try:
+            head = json.loads(raw[start:m.start()] + '"messages": []}')
+        except ValueError:
+            end = start
+            continue
+        cid = head.get("id")
+        return start, (cid if isinstance(cid, int) else None), head.get("name") or "(без названия)"
+    # не разобралась и так (битая шапка) — ближайшая '{', поля достаём регэкспами
+    start = raw.rfind("{", lo, m.start())
+    if start < 0:
+        return None
+    head = raw[start:m.start()]
+    return start, chat_id_from_obj_str(head), chat_name_from_obj_str(head) or "(без названия)"
+
+def list_all_chats(raw: str, cap: int = 10000) -> List[Chat]:
+    """
+    Чаты файла по якорям "messages": [ — ровно по одному на чат (кавычки в текстах
+    экранированы, ложных совпадений нет). Сообщения здесь не декодируются вовсе:
+    чат кончается не дальше начала следующего, а iter_messages всё равно встанет на ']'.
+    Работает одинаково для chats.list, одиночного чата и «склейки» из нескольких чатов.
+    """
+    heads: List[Tuple[int, Optional[int], str]] = []
+    lo = chats_list_start(raw) or 0
+    for m in _RE_MSGS.finditer(raw, lo):
+        if len(heads) >= cap:
+            break
+        head = chat_head(raw, lo, m)
+        lo = m.end()
+        if head:
+            heads.append(head)
 
-    # Нет chats.list → файл может быть «склейкой» из нескольких чатов.
-    i = 0
-    k = 0
     n = len(raw)
-    while i < n and k < cap:
-        obj_str, i2 = stream_next_object(raw, i)
-        if not obj_str:
-            i += 1   # главное — не ломаться
-            continue
-        if find_messages_array_in(obj_str):
-            out.append((
-                obj_str,
-                chat_id_from_obj_str(obj_str),
-                chat_name_from_obj_str(obj_str) or "(без названия)"
-            ))
-            k += 1
-        i = i2 if i2 > i else i + 1
+    ends = [start for start, _, _ in heads[1:]] + [n]
+    out = [((start, end), cid, name, u_norm(name).lower()) for (start, cid, name), end in zip(heads, ends)]
+    if out:
+        return out
 
     # Если ничего не нашли, падаем обратно на «один чат»
-    return out or [(raw, chat_id_from_obj_str(raw), chat_name_from_obj_str(raw) or "(single chat export)")]
+    name = chat_name_from_obj_str(raw) or "(single chat export)"
+    return [((0, n), chat_id_from_obj_str(raw), name, u_norm(name).lower())]
 
-def pick_chat_container(raw: str, chat_query: Optional[str], chat_id: Optional[int]) -> Tuple[str, str]:
+def pick_chat_container(raw: str, chat_query: Optional[str], chat_id: Optional[int]) -> Tuple[Span, str]:
     chats = list_all_chats(raw)
     print("\nНайденные чаты:")
-    for i, (_, cid, nm) in enumerate(chats[:200], 1):
+    for i, (_, cid, nm, _) in enumerate(chats[:200], 1):
         print(f"{i:2d}. {nm} [id={cid}]")
     if not chats:
         raise ValueError("Не найден ни один чат в файле.")
 
     if chat_id is not None:
-        for obj_str, cid, name in chats:
+        for span, cid, name, _ in chats:
             if cid == chat_id:
-                return obj_str, name
-        sample = "\n".join(f"- {nm} [id={ci}]" for _, ci, nm in chats[:30])
+                return span, name
+        sample = "\n".join(f"- {nm} [id={ci}]" for _, ci, nm, _ in chats[:30])
         raise ValueError(f"Чат с id={chat_id} не найден. Примеры:\n{sample}")
 
     if chat_query:
         q = u_norm(chat_query).lower()
-        # точное
-        for obj_str, cid, name in chats:
-            if u_norm(name).lower() == q:
-                return obj_str, name
+        # точное — словарём (при совпадении имён побеждает первый чат)
+        by_name: Dict[str, Tuple[Span, str]] = {}
+        for span, _, name, lname in chats:
+            by_name.setdefault(lname, (span, name))
+        if q in by_name:
+            return by_name[q]
         # содержит
-        for obj_str, cid, name in chats:
-            if q in u_norm(name).lower():
-                return obj_str, name
+        for span, _, name, lname in chats:
+            if q in lname:
+                return span, name
         # начинается с
-        for obj_str, cid, name in chats:
-            if u_norm(name).lower().startswith(q):
-                return obj_str, name
-        sample = "\n".join(f"- {nm} [id={ci}]" for _, ci, nm in chats[:30])
+        for span, _, name, lname in chats:
+            if lname.startswith(q):
+                return span, name
+        sample = "\n".join(f"- {nm} [id={ci}]" for _, ci, nm, _ in chats[:30])
         raise ValueError(f"Чат по маске '{chat_query}' не найден. Примеры:\n{sample}")
 
     # По умолчанию — первый не «Избранное»
-    for obj_str, cid, name in chats:
-        if not is_saved_chat(name):
-            return obj_str, name
+    for span, _, name, lname in chats:
+        if not is_saved_chat(lname):
+            return span, name
     return chats[0][0], chats[0][2]
 
-# ---------- индекс ----------
-def build_id_index(messages: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
-    idx: Dict[int, Dict[str, Any]] = {}
-    for m in messages:
-        if m.get("type") != "message":
-            continue
-        mid = m.get("id")
-        if mid is None:
-            continue
-        try:
-            mid = int(mid)
-        except Exception:
-            continue
-        idx[mid] = m
-    return idx
-
-# ---------- сборка строк из одного контейнера ----------
-def collect_rows_from_container(container_str: str,
-                                chat_name: str,
-                                user_id: Optional[int],
-                                user_query: Optional[str],
-                                exact: bool) -> List[Dict[str, Any]]:
-    messages = stream_parse_messages_from_container(container_str)
-    id_index = build_id_index(messages)
-
-    want_uid_str = want_user_id_string(user_id) if user_id is not None else None
-    uq = (user_query or "").lower() if user_query else ""
-    rows: List[Dict[str, Any]] = []
-
-    for msg in messages:
-        if msg.get("type") != "message":
+# ---------- сборка строк одного чата ----------
+class Row:
+    """Строка вывода; порядок полей — как колонки CSV (from → from_)."""
+    __slots__ = ("chat", "id", "date", "from_", "from_id", "text",
+                 "reply_to_id", "reply_from", "reply_date", "reply_text")
+
+    def __init__(self, chat, id, date, from_, from_id, text, reply_to_id,
+                 reply_from="", reply_date="", reply_text=""):
+        self.chat = chat
+        self.id = id
+        self.date = date
+        self.from_ = from_
+        self.from_id = from_id
+        self.text = text
+        self.reply_to_id = reply_to_id
+        self.reply_from = reply_from
+        self.reply_date = reply_date
+        self.reply_text = reply_text
+
+    def astuple(self) -> tuple:
+        return (self.chat, self.id, self.date, self.from_, self.from_id, self.text,
+                self.reply_to_id, self.reply_from, self.reply_date, self.reply_text)
+
+def iter_rows(raw: str,
+              span: Span,
+              chat_name: str,
+              user_id: Optional[int],
+              user_query: Optional[str],
+              exact: bool) -> Iterator[Row]:
+    """
+    Строки вывода по сообщениям автора в чате raw[span]. Индекса всех сообщений чата нет:
+    сначала собираются строки автора и id, на которые он отвечает, затем декодируются
+    только эти цели ответов. Память — O(найденных + целей), а не O(размера чата).
+    """
+    is_author = author_filter(user_id, user_query, exact)
+    # при --user-id сообщения чужих авторов можно даже не декодировать
+    author = author_pattern(user_id)
+
+    rows: List[Row] = []
+    need: Set[str] = set()
+
+    for msg in iter_messages(raw, span, author):
+        if msg.get("type") != "message" or not is_author(msg):
             continue
 
-        # фильтрация по автору
-        if want_uid_str:
-            if norm_from_id(msg) != want_uid_str:
-                continue
-        else:
-            sender = norm_sender(msg)
-            s_norm = sender.lower()
-            if exact:
-                if sender != (user_query or ""):
-                    continue
-            else:
-                if uq not in s_norm:
-                    continue
-
         text = extract_text(msg).strip()
         if not text:
             continue
 
-        mid = msg.get("id")
-        date = msg.get("date")
         reply_id = msg.get("reply_to_message_id")
-
-        r_from = r_date = r_text = ""
         if reply_id is not None:
-            try:
-                rmsg = id_index.get(int(reply_id))
-            except Exception:
-                rmsg = None
+            need.add(str(reply_id))
+
+        rows.append(Row(chat_name, msg.get("id"), msg.get("date"), norm_sender(msg),
+                        norm_from_id(msg), text, reply_id))
+
+    targets = messages_by_id(raw, span, need) if need else {}
+    for row in rows:
+        if row.reply_to_id is not None:
+            rmsg = targets.get(str(row.reply_to_id))
             if rmsg:
-                r_from = norm_sender(rmsg)
-                r_date = rmsg.get("date") or ""
-                r_text = extract_text(rmsg).strip()
-
-        rows.append({
-            "chat": chat_name,
-            "id": mid,
-            "date": date,
-            "from": norm_sender(msg),
-            "from_id": norm_from_id(msg),
-            "text": text,
-            "reply_to_id": reply_id,
-            "reply_from": r_from,
-            "reply_date": r_date,
-            "reply_text": r_text
-        })
-    return rows
+                row.reply_from = norm_sender(rmsg)
+                row.reply_date = rmsg.get("date") or ""
+                row.reply_text = extract_text(rmsg).strip()
+        yield row
+
+# ---------- параллельный обход чатов ----------
+def chat_rows(text: str, chat_name: str, user_id: Optional[int],
+              user_query: Optional[str], exact: bool) -> List[Row]:
+    """Все строки одного чата в воркере; text — только кусок экспорта с этим чатом."""
+    return list(iter_rows(text, (0, len(text)), chat_name, user_id, user_query, exact))
+
+def rows_by_chat(raw: str,
+                 chats: List[Chat],
+                 user_id: Optional[int],
+                 user_query: Optional[str],
+                 exact: bool,
+                 jobs: int) -> Iterator[Iterable[Row]]:
+    """
+    Строки каждого чата — в порядке chats. Чаты независимы, так что при jobs > 1 они
+    разбираются в пуле процессов (GIL не мешает). В воркер уходит кусок raw с чатом
+    (через pickle — за весь обход через IPC проходит весь экспорт), в полёте не больше
+    2*jobs кусков.
+    """
+    if jobs <= 1 or len(chats) <= 1:
+        for span, _, name, _ in chats:
+            yield iter_rows(raw, span, name, user_id, user_query, exact)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        pending = deque()
+        for (start, end), _, name, _ in chats:
+            pending.append(ex.submit(chat_rows, raw[start:end], name, user_id, user_query, exact))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# ---------- вывод ----------
+CSV_FIELDS = [
+    "chat","id","date","from","from_id","text",
+    "reply_to_id","reply_from","reply_date","reply_text"
+]
+
+# постоянные куски TXT-блока и буфер вывода (1 МиБ вместо 8 КиБ по умолчанию)
+TXT_SEP = "\n" + "-"*80 + "\n\n"
+TXT_NO_REPLY_TEXT = "    > [без текста или медиа]\n"
+OUT_BUFFER = 1 << 20
+
+def csv_writer(fc) -> Any:
+    """csv.writer (excel, QUOTE_MINIMAL), уже с заголовком."""
+    w = csv.writer(fc, dialect="excel", quoting=csv.QUOTE_MINIMAL)
+    w.writerow(CSV_FIELDS)
+    return w
+
+def write_row(f, w, r: Row) -> None:
+    """Пишет строку сразу в оба вывода: блок в TXT (одним f.write) и запись в CSV (w — csv.writer)."""
+    head = f"[{r.date}] {r.from_} ({r.from_id}) id={r.id}:\n{r.text}\n"
+    if r.reply_to_id:
+        quote = ("    > " + r.reply_text.replace('\n', '\n    > ') + "\n") if r.reply_text else TXT_NO_REPLY_TEXT
+        f.write(f"{head}\n  ↳ В ответ на (id={r.reply_to_id}) [{r.reply_date}] {r.reply_from}:\n{quote}{TXT_SEP}")
+    else:
+        f.write(head + TXT_SEP)
+    w.writerow(r.astuple())
 
 # ---------- main ----------
 def main():
@@ -326,9 +594,14 @@ def main():
     # вывод
     ap.add_argument("--txt-out", dest="txt_out", default=None, help="Путь TXT")
     ap.add_argument("--csv-out", dest="csv_out", default=None, help="Путь CSV")
+    # производительность
+    # пул по умолчанию выключен: каждый чат копируется в воркер через pickle, и для
+    # --user-id (поиск по тексту без разбора) это дороже самого поиска
+    ap.add_argument("--jobs", type=int, default=1,
+                    help="Сколько процессов разбирают чаты при обходе всех чатов (по умолчанию 1 — без пула)")
     args = ap.parse_args()
 
-    raw = strip_bom(open(args.in_path, "r", encoding="utf-8").read())
+    raw = read_export(args.in_path)
 
     # валидация фильтра автора
     if args.user_id is None and not args.user:
@@ -336,33 +609,26 @@ def main():
 
     user_query = u_norm(args.user) if args.user else None
 
+    who = f"user-id={args.user_id}" if args.user_id is not None else f"user~'{user_query}'"
+
     # режим 1: указан конкретный чат => как раньше, один контейнер
     if args.chat or args.chat_id is not None:
-        container, chat_name = pick_chat_container(raw, args.chat, args.chat_id)
-        rows = collect_rows_from_container(container, chat_name, args.user_id, user_query, args.exact)
+        span, chat_name = pick_chat_container(raw, args.chat, args.chat_id)
 
         txt_path = args.txt_out or f"messages_{args.user_id or (user_query or 'user')}.txt"
         csv_path = args.csv_out or f"messages_{args.user_id or (user_query or 'user')}.csv"
 
-        with open(txt_path, "w", encoding="utf-8") as f:
-            who = f"user-id={args.user_id}" if args.user_id is not None else f"user~'{user_query}'"
+        total = 0
+        with open(txt_path, "w", encoding="utf-8", buffering=OUT_BUFFER) as f, \
+             open(csv_path, "w", encoding="utf-8", newline="", buffering=OUT_BUFFER) as fc:
+            w = csv_writer(fc)
             f.write(f"# Чат: {chat_name}\n# Фильтр: {who}\n\n")
-            for r in rows:
-                f.write(f"[{r['date']}] {r['from']} ({r['from_id']}) id={r['id']}:\n{r['text']}\n")
-                if r["reply_to_id"]:
-                    f.write(f"\n  ↳ В ответ на (id={r['reply_to_id']}) [{r['reply_date']}] {r['reply_from']}:\n")
-                    f.write(("    > " + r["reply_text"].replace('\n', '\n    > ') + "\n") if r["reply_text"] else "    > [без текста или медиа]\n")
-                f.write("\n" + "-"*80 + "\n\n")
-
-        with open(csv_path, "w", encoding="utf-8", newline="") as f:
-            w = csv.DictWriter(f, fieldnames=[
-                "chat","id","date","from","from_id","text",
-                "reply_to_id","reply_from","reply_date","reply_text"
-            ])
-            w.writeheader(); w.writerows(rows)
+            for r in iter_rows(raw, span, chat_name, args.user_id, user_query, args.exact):
+                write_row(f, w, r)
+                total += 1
 
         print(f"Чат: {chat_name}")
-        print(f"Найдено сообщений: {len(rows)}")
+        print(f"Найдено сообщений: {total}")
         print(f"TXT: {txt_path}")
         print(f"CSV: {csv_path}")
         return
@@ -370,50 +636,37 @@ def main():
     # режим 2: НЕ указан чат => обходим ВСЕ чаты
     chats = list_all_chats(raw)
     print("\nНайденные чаты:")
-    for i, (_, cid, nm) in enumerate(chats[:200], 1):
+    for i, (_, cid, nm, _) in enumerate(chats[:200], 1):
         print(f"{i:2d}. {nm} [id={cid}]")
 
-    all_rows: List[Dict[str, Any]] = []
-    per_chat_counts: List[Tuple[str, int]] = []
-
-    for obj_str, cid, name in chats:
-        rows = collect_rows_from_container(obj_str, name, args.user_id, user_query, args.exact)
-        if rows:
-            per_chat_counts.append((f"{name} [id={cid}]", len(rows)))
-            all_rows.extend(rows)
-
     txt_path = args.txt_out or f"messages_{args.user_id or (user_query or 'user')}_ALL.txt"
     csv_path = args.csv_out or f"messages_{args.user_id or (user_query or 'user')}_ALL.csv"
 
-    # TXT: группируем по чату для удобства
-    by_chat: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
-    for r in all_rows:
-        by_chat[r["chat"]].append(r)
+    per_chat_counts: Counter = Counter()
 
-    with open(txt_path, "w", encoding="utf-8") as f:
-        who = f"user-id={args.user_id}" if args.user_id is not None else f"user~'{user_query}'"
+    with open(txt_path, "w", encoding="utf-8", buffering=OUT_BUFFER) as f, \
+         open(csv_path, "w", encoding="utf-8", newline="", buffering=OUT_BUFFER) as fc:
+        w = csv_writer(fc)
         f.write(f"# Все чаты\n# Фильтр: {who}\n\n")
-        for chat in sorted(by_chat.keys()):
-            f.write(f"## Чат: {chat}\n\n")
-            for r in by_chat[chat]:
-                f.write(f"[{r['date']}] {r['from']} ({r['from_id']}) id={r['id']}:\n{r['text']}\n")
-                if r["reply_to_id"]:
-                    f.write(f"\n  ↳ В ответ на (id={r['reply_to_id']}) [{r['reply_date']}] {r['reply_from']}:\n")
-                    f.write(("    > " + r["reply_text"].replace('\n', '\n    > ') + "\n") if r["reply_text"] else "    > [без текста или медиа]\n")
-                f.write("\n" + "-"*80 + "\n\n")
-
-    with open(csv_path, "w", encoding="utf-8", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=[
-            "chat","id","date","from","from_id","text",
-            "reply_to_id","reply_from","reply_date","reply_text"
-        ])
-        w.writeheader(); w.writerows(all_rows)
+        # TXT группируется по чату: чаты заранее сортируются по нормализованному названию
+        # (одинаковые имена — подряд), строки пишутся сразу, секция "## Чат"
+        # открывается на первой найденной строке
+        last_chat = None
+        chats.sort(key=lambda c: (c[3], c[2]))
+        results = rows_by_chat(raw, chats, args.user_id, user_query, args.exact, args.jobs)
+        for (span, cid, name, _), rows in zip(chats, results):
+            for r in rows:
+                if name != last_chat:
+                    f.write(f"## Чат: {name}\n\n")
+                    last_chat = name
+                write_row(f, w, r)
+                per_chat_counts[f"{name} [id={cid}]"] += 1
 
     print("\nИтоги по чатам (где что-то нашлось):")
-    for name, cnt in per_chat_counts:
+    for name, cnt in per_chat_counts.items():
         print(f"- {name}: {cnt}")
 
-    print(f"\nВсего найдено сообщений: {len(all_rows)}")
+    print(f"\nВсего найдено сообщений: {sum(per_chat_counts.values())}")
     print(f"TXT: {txt_path}")
     print(f"CSV: {csv_path}")
 